@@ -1,13 +1,21 @@
+import codecs
+import functools
+import hashlib
+import io
+import itertools
 import os
 import sys
 import re
 import json
 import tempfile
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ---------------------- ENV ----------------------
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
@@ -17,22 +25,66 @@ PR_NUMBER      = os.environ.get("PR_NUMBER")       # set by workflow
 EVENT_NAME     = os.environ.get("EVENT_NAME", "")
 COMMENT_BODY   = os.environ.get("COMMENT_BODY", "")
 OPENAI_MODEL   = os.environ.get("OPENAI_MODEL", "gpt-4o-mini")
+# Persisted between workflow runs by actions/cache (see chat-fix.yml)
+CACHE_DIR      = Path(os.environ.get("RUNNER_TEMP") or tempfile.gettempdir()) / "chat-patch-cache"
 
 API_URL = "https://api.github.com"
 
+# One keep-alive connection for every GitHub call in the run, with backoff
+# on 5xx and secondary rate limits.
+_SESSION = requests.Session()
+_SESSION.headers.update({
+    "Authorization": f"Bearer {GITHUB_TOKEN}",
+    "Accept": "application/vnd.github+json",
+})
+_SESSION.mount(API_URL, HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "POST"]),
+        raise_on_status=False,
+    ),
+))
+
 # ---------------------- Helpers ----------------------
 def log(msg: str):
     print(msg, flush=True)
 
 def gh(path, method="GET", **kwargs):
-    headers = {
-        "Authorization": f"Bearer {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github+json",
-    }
-    r = requests.request(method, f"{API_URL}{path}", headers=headers, **kwargs)
+    r = _SESSION.request(method, f"{API_URL}{path}", **kwargs)
     r.raise_for_status()
     return r
 
+_ETAGS = None
+
+def _etag_cache() -> dict:
+    global _ETAGS
+    if _ETAGS is None:
+        try:
+            _ETAGS = json.loads(cache_path("gh_etag.json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            _ETAGS = {}
+    return _ETAGS
+
+def gh_json(path: str):
+    """Conditional GET: a 304 reply is served from the ETag cache and does
+    not count against the primary rate limit."""
+    etags = _etag_cache()
+    hit = etags.get(path)
+    headers = {"If-None-Match": hit["etag"]} if hit else {}
+    r = gh(path, headers=headers)
+    if r.status_code == 304 and hit:
+        return hit["body"]
+    body = r.json()
+    etag = r.headers.get("ETag")
+    if etag:
+        etags[path] = {"etag": etag, "body": body}
+        cache_path("gh_etag.json").write_text(json.dumps(etags), encoding="utf-8")
+    return body
+
 def comment(body: str):
     if not (GITHUB_TOKEN and REPO and PR_NUMBER):
         log("No PR context to comment; printing instead:\n" + body)
@@ -43,27 +95,65 @@ def get_pr():
     if not (REPO and PR_NUMBER):
         log("❗ No REPO/PR_NUMBER; exiting.")
         sys.exit(0)
-    return gh(f"/repos/{REPO}/pulls/{PR_NUMBER}").json()
+    return gh_json(f"/repos/{REPO}/pulls/{PR_NUMBER}")
 
 def get_issue_comments() -> List[dict]:
     # PR comments live under /issues/:number/comments
-    r = gh(f"/repos/{REPO}/issues/{PR_NUMBER}/comments")
-    return r.json()
+    return gh_json(f"/repos/{REPO}/issues/{PR_NUMBER}/comments")
 
-def run(cmd: List[str]) -> subprocess.CompletedProcess:
+def run(cmd: List[str], input: Optional[str] = None) -> subprocess.CompletedProcess:
     log(f"$ {' '.join(cmd)}")
-    return subprocess.run(cmd, text=True, capture_output=True, check=False)
+    return subprocess.run(cmd, input=input, text=True, capture_output=True, check=False)
+
+def cache_path(name: str) -> Path:
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    return CACHE_DIR / name
 
+@functools.lru_cache(maxsize=4)
 def get_unified_diff(base_sha: str, head_sha: str) -> str:
-    cp = run(["git", "diff", "--unified", f"{base_sha}..{head_sha}"])
-    if cp.returncode != 0:
-        log(cp.stderr or cp.stdout)
-    return cp.stdout
+    cached = cache_path(f"{base_sha}-{head_sha}.diff")
+    if cached.exists():
+        log(f"Using cached diff {cached.name}")
+    else:
+        # Let git write straight to disk instead of buffering stdout in Python.
+        cmd = ["git", "diff", "--no-color", "--no-ext-diff", "--unified", f"{base_sha}..{head_sha}"]
+        log(f"$ {' '.join(cmd)}")
+        partial = cached.with_suffix(".partial")
+        with open(partial, "wb") as out:
+            cp = subprocess.run(cmd, stdout=out, stderr=subprocess.PIPE, text=False, check=False)
+        if cp.returncode != 0:
+            log(cp.stderr.decode("utf-8", errors="ignore"))
+            partial.unlink(missing_ok=True)
+            return ""
+        os.replace(partial, cached)
+    if cached.stat().st_size == 0:
+        return ""
+    return cached.read_text(encoding="utf-8", errors="ignore")
 
+def is_whitespace_only(base_sha: str, head_sha: str) -> bool:
+    # --quiet exits 0 when nothing but whitespace differs (1 = real changes)
+    cp = run(["git", "diff", "--ignore-all-space", "--quiet", f"{base_sha}..{head_sha}"])
+    if cp.returncode != 0:
+        return False
+    # ...but it also exits 0 for renames, mode changes and added/deleted empty
+    # files. Only in-place edits that keep the mode count as whitespace.
+    raw = run(["git", "diff", "--raw", "--no-renames", f"{base_sha}..{head_sha}"])
+    for line in raw.stdout.splitlines():
+        old_mode, new_mode, _, _, status = line.split("\t", 1)[0].lstrip(":").split()
+        if status != "M" or old_mode != new_mode:
+            return False
+    return True
+
+@functools.lru_cache(maxsize=4)
 def get_changed_files(base_sha: str, head_sha: str) -> List[str]:
-    cp = run(["git", "diff", "--name-only", f"{base_sha}..{head_sha}"])
-    files = [ln.strip() for ln in (cp.stdout or "").splitlines() if ln.strip()]
-    return files
+    # -z NUL-terminates paths: exact splitting, no per-line strip, and no
+    # quoting of unusual file names.
+    cmd = ["git", "diff", "-z", "--name-only", f"{base_sha}..{head_sha}"]
+    log(f"$ {' '.join(cmd)}")
+    cp = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    if cp.returncode != 0:
+        log(cp.stderr.decode("utf-8", errors="ignore"))
+    return [os.fsdecode(p) for p in cp.stdout.split(b"\0") if p]
 
 def read_file(path: str) -> str:
     try:
@@ -71,35 +161,132 @@ def read_file(path: str) -> str:
     except Exception:
         return ""
 
+def read_files_at(rev: str, paths: List[str]) -> Dict[str, str]:
+    """Read all `paths` as of `rev` with one `git cat-file --batch` process.
+    Paths git does not know at `rev` fall back to the working tree."""
+    if not paths:
+        return {}
+    log(f"$ git cat-file --batch ({len(paths)} paths @ {rev[:7]})")
+    cp = subprocess.run(
+        ["git", "cat-file", "--batch"],
+        input="".join(f"{rev}:{p}\n" for p in paths).encode("utf-8"),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False,
+    )
+    out = cp.stdout
+    pos = 0
+    contents: Dict[str, str] = {}
+    for path in paths:
+        nl = out.find(b"\n", pos)
+        if nl < 0:
+            break
+        header = out[pos:nl].split()
+        pos = nl + 1
+        if len(header) != 3 or not header[2].isdigit():
+            continue  # "<ref> missing" / "ambiguous"
+        size = int(header[2])
+        if header[1] == b"blob":
+            contents[path] = out[pos:pos + size].decode("utf-8", errors="ignore")
+        pos += size + 1
+    for path in paths:
+        if path not in contents:
+            contents[path] = read_file(path)
+    return contents
+
 # ---------------------- Diff validation ----------------------
 def ensure_valid_unified_diff(patch: str) -> bool:
     if not patch:
         return False
-    tokens = ("diff --git", "--- a/", "+++ b/", "@@")
-    return all(t in patch for t in tokens)
+    # The markers appear in this order in any real diff, so one forward
+    # walk suffices and a missing marker stops the scan early.
+    pos = 0
+    for token in ("diff --git", "--- a/", "+++ b/", "@@"):
+        pos = patch.find(token, pos)
+        if pos < 0:
+            return False
+    return True
+
+_TRAILING_WS_RE = re.compile(r"[ \t]+(\r?\n)")
 
 def sanitize_patch_whitespace(patch: str) -> str:
-    return re.sub(r"[ \t]+(\r?\n)", r"\1", patch)
-
-def dump_rejects_as_comment():
-    ls = run(["bash", "-lc", "ls -1 **/*.rej 2>/dev/null | head -n 10"])
-    if ls.returncode == 0 and ls.stdout.strip():
-        files = ls.stdout.strip().splitlines()
-        chunks = []
-        for f in files:
-            try:
-                txt = Path(f).read_text(errors="ignore")
-                chunks.append(f"\n--- {f} ---\n{txt}\n")
-            except Exception:
-                pass
-        if chunks:
-            joined = "".join(chunks)
-            comment("**Reject files (.rej)**:\n```\n" + joined[:65000] + "\n```")
+    return _TRAILING_WS_RE.sub(r"\1", patch)
+
+def _reject_files():
+    """Yield .rej files under the working tree without descending into .git."""
+    for dirpath, dirnames, filenames in os.walk("."):
+        if ".git" in dirnames:
+            dirnames.remove(".git")
+        for name in filenames:
+            if name.endswith(".rej"):
+                yield Path(dirpath, name)
+
+def format_rejects(limit: int) -> str:
+    """Markdown section with the contents of up to 10 .rej files, or ''."""
+    chunks = []
+    for p in itertools.islice(_reject_files(), 10):
+        try:
+            txt = p.read_text(errors="ignore")
+            chunks.append(f"\n--- {p} ---\n{txt}\n")
+        except Exception:
+            pass
+    if not chunks:
+        return ""
+    joined = "".join(chunks)
+    return "\n\n**Reject files (.rej)**:\n```\n" + joined[:limit] + "\n```"
+
+# ---------------------- Prompt context ----------------------
+_HUNK_RE = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@", re.M)
+CONTEXT_LINES = 40
+
+def _new_side_path(line: str) -> Optional[str]:
+    """Path from a `+++ ` header, or None for /dev/null."""
+    # git appends a tab after names containing spaces and C-quotes names with
+    # special characters (`+++ "b/caf\303\251.py"`).
+    rest = line[4:]
+    if rest.endswith("\t"):
+        rest = rest[:-1]
+    if rest.startswith('"') and rest.endswith('"'):
+        raw = codecs.escape_decode(rest[1:-1].encode("utf-8"))[0]
+        rest = os.fsdecode(raw)
+    return rest[2:] if rest.startswith("b/") else None
+
+def hunk_ranges(diff_text: str) -> Dict[str, List[Tuple[int, int]]]:
+    """Map each changed path to the (start, length) of its new-side hunks."""
+    ranges: Dict[str, List[Tuple[int, int]]] = {}
+    current = None
+    for line in diff_text.splitlines():
+        if line.startswith("+++ "):
+            current = _new_side_path(line)
+        elif current and line.startswith("@@"):
+            m = _HUNK_RE.match(line)
+            if m:
+                length = int(m.group(2)) if m.group(2) is not None else 1
+                ranges.setdefault(current, []).append((int(m.group(1)), length))
+    return ranges
+
+def file_excerpts(content: str, hunks: List[Tuple[int, int]]) -> str:
+    """Keep only CONTEXT_LINES around each hunk, merging windows that overlap."""
+    lines = content.splitlines()
+    windows: List[List[int]] = []
+    for start, length in sorted(hunks):
+        lo = max(0, start - 1 - CONTEXT_LINES)
+        hi = min(len(lines), start - 1 + length + CONTEXT_LINES)
+        if windows and lo <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], hi)
+        else:
+            windows.append([lo, hi])
+    parts = [f"@@ lines {lo + 1}-{hi} @@\n" + "\n".join(lines[lo:hi]) for lo, hi in windows]
+    return "\n...\n".join(parts)
 
 # ---------------------- OpenAI ----------------------
+# Cache file behind the most recent model answer, so main() can drop it
+# when the patch does not apply and a re-run asks the model afresh.
+_MODEL_CACHE: Optional[Path] = None
+
 def ask_model_for_patch(diff_text: str, pr_body: str, user_hint: str, file_context: List[Tuple[str, str]], attempt: int) -> str:
+    global _MODEL_CACHE
     try:
-        from openai import OpenAI
+        import httpx
+        from openai import OpenAI, APITimeoutError
     except Exception as e:
         comment(f"❌ OpenAI SDK import failed: {e}")
         sys.exit(0)
@@ -129,59 +316,114 @@ Fix CropManage API endpoint integration using these rules:
     ctx += "Base..Head unified diff:\n"
     ctx += diff_text
 
-    # On retry, add file contents (helps the model construct correct hunks)
+    # On retry, add the code around each hunk (helps the model construct
+    # correct hunks without paying for whole files)
     if attempt > 1 and file_context:
-        ctx += "\n\nChanged files (current HEAD content follows):\n"
+        ranges = hunk_ranges(diff_text)
+        ctx += "\n\nChanged files (HEAD excerpts around each hunk follow):\n"
         for path, content in file_context[:20]:  # cap for safety
-            # keep each file body within a reasonable limit
-            snippet = content if len(content) < 50000 else content[:50000]
+            if path not in ranges:
+                continue
+            snippet = file_excerpts(content, ranges[path])
             ctx += f"\n----- BEGIN FILE: {path} -----\n{snippet}\n----- END FILE: {path} -----\n"
 
-    resp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        temperature=0.1,
-        messages=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": rules + "\n\n" + ctx},
-        ],
-    )
-    return (resp.choices[0].message.content or "")
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": rules + "\n\n" + ctx},
+    ]
+
+    # Identical prompt + model => reuse the earlier answer instead of paying
+    # for another completion on a workflow re-run.
+    key = hashlib.sha256(
+        "\0".join([OPENAI_MODEL, system, rules, ctx]).encode("utf-8")
+    ).hexdigest()
+    cached = _MODEL_CACHE = cache_path(f"{key}.patch")
+    if cached.exists():
+        log(f"Using cached model output {cached.name}")
+        return cached.read_text(encoding="utf-8")
+
+    # Stream the completion: each SSE chunk arrives well inside Cloudflare's
+    # 100 s cutoff, whereas one blocking request for a large diff may not.
+    for tries_left in (1, 0):
+        buf = io.StringIO()
+        try:
+            stream = client.chat.completions.create(
+                model=OPENAI_MODEL,
+                temperature=0.1,
+                messages=messages,
+                stream=True,
+            )
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    buf.write(delta)
+            patch = buf.getvalue()
+            # Only keep answers worth replaying; a bad one should be retried.
+            if ensure_valid_unified_diff(patch):
+                cached.write_text(patch, encoding="utf-8")
+            return patch
+        except (APITimeoutError, httpx.TimeoutException) as e:
+            # A read timeout mid-stream surfaces from httpx, not the SDK.
+            if not tries_left:
+                # End the run here: attempt 2 would only time out again
+                # and pile more comments onto the PR.
+                comment(f"❌ OpenAI request timed out: {e}")
+                sys.exit(0)
+            log("OpenAI stream timed out; retrying once...")
+    return ""
 
 # ---------------------- Apply patch ----------------------
-def apply_patch_and_push(patch_text: str):
-    tmp = Path(tempfile.gettempdir()) / "chat_fix.diff"
-    tmp.write_text(patch_text, encoding="utf-8")
-
-    # Try normal apply
-    r1 = run(["git", "apply", "--whitespace=fix", str(tmp)])
+def is_malformed_patch(apply_output: str) -> bool:
+    """True when git rejected the patch as unparsable rather than as a
+    context mismatch."""
+    return any(t in apply_output for t in ("corrupt patch", "unrecognized input", "No valid patches"))
+
+def apply_patch_and_push(patch_text: str) -> bool:
+    """Apply, commit and push; False if the patch itself would not apply."""
+    # Feed the patch on stdin; git apply is all-or-nothing, so a failed
+    # attempt leaves the tree untouched for the 3-way retry.
+    r1 = run(["git", "apply", "--whitespace=fix", "-"], input=patch_text)
     if r1.returncode != 0:
-        log("Normal apply failed; trying 3-way merge...")
-        # Try 3-way apply
-        r2 = run(["git", "apply", "--3way", "--whitespace=fix", str(tmp)])
-        if r2.returncode != 0:
+        err1 = r1.stderr or r1.stdout
+        if is_malformed_patch(err1):
+            # A 3-way merge cannot rescue a diff git cannot even parse.
+            log("Patch is malformed; skipping 3-way merge.")
+            err2 = "(skipped: patch is malformed)"
+            ok = False
+        else:
+            log("Normal apply failed; trying 3-way merge...")
+            # Try 3-way apply
+            r2 = run(["git", "apply", "--3way", "--whitespace=fix", "-"], input=patch_text)
+            err2 = r2.stderr or r2.stdout
+            ok = r2.returncode == 0
+        if not ok:
+            # One comment for the whole diagnosis; GitHub caps a body at
+            # 65536 chars, so git output, patch and rejects share that budget.
             comment("❌ Patch failed to apply.\n\n"
                     "**git apply output:**\n```\n"
-                    + (r1.stderr or r1.stdout)
+                    + err1[:2000]
                     + "\n-- 3way --\n"
-                    + (r2.stderr or r2.stdout)
+                    + err2[:2000]
                     + "\n```\n\n"
                     + "**Proposed patch (save as patch.diff and run `git apply --3way patch.diff`)**:\n```diff\n"
-                    + patch_text[:65000]
-                    + "\n```")
-            dump_rejects_as_comment()
-            return
+                    + patch_text[:45000]
+                    + "\n```"
+                    + format_rejects(limit=15000))
+            return False
 
     # Commit & push
-    run(["git", "config", "user.name", "chat-fix-bot"])
-    run(["git", "config", "user.email", "actions@github.com"])
     run(["git", "add", "-A"])
-    c = run(["git", "commit", "-m", "chore: apply chat-fix patch"])
+    c = run(["git", "-c", "user.name=chat-fix-bot", "-c", "user.email=actions@github.com",
+             "commit", "-m", "chore: apply chat-fix patch"])
     if c.returncode != 0:
         comment("ℹ️ Nothing to commit (patch was empty or already applied).")
-        return
+        return True
     p = run(["git", "push"])
     if p.returncode == 0:
         comment("✅ Patch applied by Chat Fix Bot.")
+    return True
 
 # ---------------------- Main ----------------------
 def main():
@@ -195,22 +437,35 @@ def main():
     pr_body  = pr.get("body") or ""
     log(f"PR #{PR_NUMBER}: {REPO} base={base_sha[:7]} head={head_sha[:7]} (event={EVENT_NAME})")
 
-    diff = get_unified_diff(base_sha, head_sha)
-    if not diff.strip():
-        comment("ℹ️ No changes to patch (diff is empty).")
-        return
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        # The two git subprocesses are independent; run them side by side.
+        diff_f = pool.submit(get_unified_diff, base_sha, head_sha)
+        files_f = pool.submit(get_changed_files, base_sha, head_sha)
+        ws_only_f = pool.submit(is_whitespace_only, base_sha, head_sha)
+        diff = diff_f.result()
+        if not diff.strip():
+            comment("ℹ️ No changes to patch (diff is empty).")
+            return
+        if ws_only_f.result():
+            # The rules forbid whitespace-only output; don't pay for a model call.
+            comment("ℹ️ Only whitespace changes; skipping.")
+            return
 
-    changed_files = get_changed_files(base_sha, head_sha)
-    file_ctx = [(p, read_file(p)) for p in changed_files]
+        # File contents are only needed on attempt 2; read them while
+        # attempt 1 waits on the model.
+        changed_files = files_f.result()
+        contents_f = pool.submit(read_files_at, head_sha, changed_files)
 
-    # Attempt 1: diff only + PR body + triggering comment
-    patch = ask_model_for_patch(diff, pr_body, COMMENT_BODY, [], attempt=1)
+        # Attempt 1: diff only + PR body + triggering comment
+        patch = ask_model_for_patch(diff, pr_body, COMMENT_BODY, [], attempt=1)
 
-    def valid(p): return ensure_valid_unified_diff(p)
+        def valid(p): return ensure_valid_unified_diff(p)
 
-    if not valid(patch):
-        # Attempt 2: include file contents for context
-        patch = ask_model_for_patch(diff, pr_body, COMMENT_BODY, file_ctx, attempt=2)
+        if not valid(patch):
+            # Attempt 2: include file contents for context
+            contents = contents_f.result()
+            file_ctx = [(p, contents[p]) for p in changed_files]
+            patch = ask_model_for_patch(diff, pr_body, COMMENT_BODY, file_ctx, attempt=2)
 
     if not valid(patch):
         comment("⚠️ Model did not return a valid unified diff. Skipping apply.\n\n```text\n"
@@ -218,7 +473,9 @@ def main():
         return
 
     patch = sanitize_patch_whitespace(patch)
-    apply_patch_and_push(patch)
+    if not apply_patch_and_push(patch) and _MODEL_CACHE is not None:
+        # Don't replay an answer that is known not to apply.
+        _MODEL_CACHE.unlink(missing_ok=True)
 
 if __name__ == "__main__":
     main()
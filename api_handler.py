@@ -1,23 +1,68 @@
+import json
+import time
+from collections import namedtuple
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from datetime import datetime
+from pathlib import Path
 from config import Config as conf
+from utils import normalize as _norm
+
+try:
+    import orjson  # optional: several times faster on the big lookup lists
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+# One pooled keep-alive session for every CropManage call
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+# Runs independent lookups side by side
+_POOL = ThreadPoolExecutor(max_workers=4)
+
+# Ranch / crop-type lookup tables: kind -> (token, expires_at, index)
+_INDEX_CACHE = {}
+_INDEX_TTL = 600  # seconds; long sessions still pick up edits
+_INDEX_RETRY = 60  # seconds to keep serving a stale table after a failed rebuild
+# url -> (etag, decoded payload) for the rarely-changing lookup lists
+_ETAGS = {}
 
 # ---------- AUTH ----------
+_AUTH_KEY_FILE = Path.home() / ".cache" / "cropmanage" / "auth_key"
+
+def _load_auth_key():
+    try:
+        return _AUTH_KEY_FILE.read_text(encoding="utf-8").strip()
+    except OSError:
+        return None
+
+def _save_auth_key(key):
+    try:
+        _AUTH_KEY_FILE.parent.mkdir(parents=True, exist_ok=True)
+        _AUTH_KEY_FILE.write_text(key, encoding="utf-8")
+    except OSError:
+        pass  # only an optimization for the next login
+
 def authenticate(username, password):
     """
     Robust token fetch: try both 'userName' and 'username' form keys.
     Prints server body if 4xx/5xx for easy diagnosis.
+    On success the token is also attached to the shared session.
     """
     url = conf.TOKEN_URL
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    forms = [
-        {"userName": username, "password": password, "grant_type": "password"},
-        {"username": username, "password": password, "grant_type": "password"},
-    ]
+    # Try the key that worked last time first to save a wasted round trip
+    keys = ["userName", "username"]
+    remembered = _load_auth_key()
+    if remembered in keys:
+        keys.remove(remembered)
+        keys.insert(0, remembered)
     last_err = None
-    for i, data in enumerate(forms, 1):
+    for i, key in enumerate(keys, 1):
+        data = {key: username, "password": password, "grant_type": "password"}
         try:
-            resp = requests.post(url, headers=headers, data=data, timeout=20)
+            resp = _SESSION.post(url, headers=headers, data=data, timeout=20)
             if resp.status_code >= 400:
                 # help debug: print the response text
                 print(f"Auth attempt {i} failed ({resp.status_code}): {resp.text[:600]}")
@@ -26,34 +71,109 @@ def authenticate(username, password):
             if not token:
                 print("❌ No access_token in response:", resp.text[:600])
                 continue
+            if key != remembered:
+                _save_auth_key(key)
+            set_auth_token(token)
             return token
         except requests.RequestException as e:
             last_err = e
     print("❌ Authentication failed:", last_err)
     return None
 
+def set_auth_token(token):
+    """Attach the bearer token to every subsequent request on the session."""
+    _SESSION.headers["Authorization"] = f"Bearer {token}"
+
 # ---------- COMMON LOOKUPS ----------
-def _auth_headers(token):
-    return {"Authorization": f"Bearer {token}"}
+def _json(resp):
+    """Decode a response body; a bad body still surfaces as a RequestException."""
+    try:
+        return _loads(resp.content)
+    except ValueError as e:
+        raise requests.exceptions.InvalidJSONError(str(e), response=resp)
+
+def _get_json(url, conditional=False, **kwargs):
+    """GET and decode. With conditional=True the last ETag is sent back, and
+    a 304 reuses the previously decoded payload instead of re-downloading."""
+    cached = _ETAGS.get(url) if conditional else None
+    headers = {"If-None-Match": cached[0]} if cached else None
+    resp = _SESSION.get(url, headers=headers, timeout=20, **kwargs)
+    if cached and resp.status_code == 304:
+        return cached[1]
+    resp.raise_for_status()
+    data = _json(resp)
+    etag = resp.headers.get("ETag")
+    if conditional and etag:
+        _ETAGS[url] = (etag, data)
+    return data
 
 def list_ranches(token):
     """Return the ranch list objects from /v2/ranches.json"""
-    resp = requests.get(conf.RANCHES, headers=_auth_headers(token), timeout=20)
-    resp.raise_for_status()
-    return resp.json()
+    return _get_json(conf.RANCHES, conditional=True)
+
+def _cached_index(kind, token, build):
+    """Serve a lookup table from _INDEX_CACHE, rebuilding it when the token
+    changes or the entry is older than _INDEX_TTL. If the rebuild fails, the
+    stale table for the same token is kept and retried after _INDEX_RETRY."""
+    hit = _INDEX_CACHE.get(kind)
+    now = time.monotonic()
+    if hit and hit[0] == token and hit[1] > now:
+        return hit[2]
+    try:
+        index = build(token)
+    except Exception:
+        if not (hit and hit[0] == token):
+            raise
+        _INDEX_CACHE[kind] = (token, now + _INDEX_RETRY, hit[2])
+        return hit[2]
+    _INDEX_CACHE[kind] = (token, now + _INDEX_TTL, index)
+    return index
+
+def _build_ranch_index(token):
+    index = {}
+    for r in list_ranches(token):
+        name = _norm(r.get("Name"))
+        if name:
+            # v2 returns Id; sometimes Ranch_External_GUID appears
+            index.setdefault(name, (r.get("Id"), r.get("Ranch_External_GUID")))
+    return index
+
+def _build_crop_type_index(token):
+    index = {}
+    for c in _get_json(conf.CROP_TYPES, conditional=True):
+        name = _norm(c.get("Name"))
+        if name:
+            # v2 usually exposes Id + Name for crop types
+            index.setdefault(name, c.get("Id") or c.get("CropTypeId"))
+    return index
+
+def _ranch_index(token):
+    """{normalized ranch name: (Id, Ranch_External_GUID)}"""
+    return _cached_index("ranches", token, _build_ranch_index)
+
+def _crop_type_index(token):
+    """{normalized crop type name: Id}"""
+    return _cached_index("crop_types", token, _build_crop_type_index)
+
+def warmup(token):
+    """Load the ranch and crop-type tables in parallel so later lookups are
+    served from memory. Returns True if both loaded; failures are left for
+    get_crops/get_locations to report."""
+    futures = [_POOL.submit(_ranch_index, token), _POOL.submit(_crop_type_index, token)]
+    ok = True
+    for f in futures:
+        try:
+            f.result()
+        except Exception:
+            ok = False
+    return ok
 
 def get_ranch_identifiers(ranch_name, token):
     """
     Find a ranch by name (case/space-insensitive).
     Return (numeric_id, external_guid_or_none).
     """
-    target = (ranch_name or "").strip().lower()
-    for r in list_ranches(token):
-        name = (r.get("Name") or "").strip().lower()
-        if name == target:
-            # v2 returns Id; sometimes Ranch_External_GUID appears
-            return r.get("Id"), r.get("Ranch_External_GUID")
-    return None, None
+    return _ranch_index(token).get(_norm(ranch_name), (None, None))
 
 def get_ranch_id(ranch_name, token):
     rid, _ = get_ranch_identifiers(ranch_name, token)
@@ -61,33 +181,33 @@ def get_ranch_id(ranch_name, token):
 
 def get_crop_type_id(crop_name, token):
     """Return crop type Id by exact case-insensitive match on Name."""
-    resp = requests.get(conf.CROP_TYPES, headers=_auth_headers(token), timeout=20)
-    resp.raise_for_status()
-    crop_name = (crop_name or "").strip().lower()
-    for c in resp.json():
-        # v2 usually exposes Id + Name for crop types
-        if (c.get("Name") or "").strip().lower() == crop_name:
-            return c.get("Id") or c.get("CropTypeId")
-    return None
+    return _crop_type_index(token).get(_norm(crop_name))
 
 def get_crops(token):
     try:
-        resp = requests.get(conf.CROP_TYPES, headers=_auth_headers(token), timeout=20)
-        resp.raise_for_status()
-        return [(c.get("Name") or "").lower() for c in resp.json() if c.get("Name")]
+        return list(_crop_type_index(token))
     except Exception as e:
         print("❌ Could not load crops:", e)
         return []
 
 def get_locations(token):
     try:
-        ranches = list_ranches(token)
-        return [(r.get("Name") or "").lower() for r in ranches if r.get("Name")]
+        return list(_ranch_index(token))
     except Exception as e:
         print("❌ Could not load locations:", e)
         return []
 
 # ---------- WEATHER ----------
+# Example-only fields; adjust to your actual payload
+Station = namedtuple("Station", "temp_c conditions wind_speed")
+
+def _station(raw):
+    return Station(raw.get("temp_c", "?"), raw.get("conditions", "?"), raw.get("wind_speed", "?"))
+
+def _format_weather(station):
+    return (f"Current weather: {station.temp_c}°C, "
+            f"{station.conditions}, Wind: {station.wind_speed} kph")
+
 def get_weather_update(location, token):
     """
     Try GUID first: /v2/weather/stations.json?ranchGuid=...
@@ -95,28 +215,28 @@ def get_weather_update(location, token):
     """
     ranch_id, ranch_guid = get_ranch_identifiers(location, token)
     if not (ranch_guid or ranch_id):
-        return "❌ Location not found"
+        return f"❌ Location '{location}' not found"
 
-    # try GUID
-    try:
-        resp = requests.get(conf.WEATHER_STATIONS, headers=_auth_headers(token),
-                            params={"ranchGuid": ranch_guid} if ranch_guid else None, timeout=20)
-        if resp.status_code == 200 and resp.json():
-            station = resp.json()[0]
-            # Example-only fields; adjust to your actual payload
-            return (f"Current weather: {station.get('temp_c','?')}°C, "
-                    f"{station.get('conditions','?')}, Wind: {station.get('wind_speed','?')} kph")
-    except requests.RequestException:
-        pass
+    # try GUID (never send an empty filter: that lists every station)
+    if ranch_guid:
+        try:
+            resp = _SESSION.get(conf.WEATHER_STATIONS, params={"ranchGuid": ranch_guid}, timeout=20)
+            stations = _json(resp) if resp.status_code == 200 else None
+            if stations:
+                return _format_weather(_station(stations[0]))
+        except requests.RequestException:
+            pass
+    if not ranch_id:
+        return f"❌ Weather data unavailable for {location}"
 
     # fallback numeric
     try:
-        resp = requests.get(conf.WEATHER_STATIONS, headers=_auth_headers(token),
-                            params={"ranchId": ranch_id} if ranch_id else None, timeout=20)
+        resp = _SESSION.get(conf.WEATHER_STATIONS, params={"ranchId": ranch_id}, timeout=20)
         resp.raise_for_status()
-        station = resp.json()[0]
-        return (f"Current weather: {station.get('temp_c','?')}°C, "
-                f"{station.get('conditions','?')}, Wind: {station.get('wind_speed','?')} kph")
+        stations = _json(resp)
+        if not stations:
+            return f"❌ No weather stations found for {location}"
+        return _format_weather(_station(stations[0]))
     except requests.RequestException as e:
         return f"❌ Weather data unavailable: {str(e)}"
 
@@ -130,7 +250,6 @@ def get_plantings_for_ranch(token, ranch_name, active=True, commodity_type_id=No
     if not (ranch_id or ranch_guid):
         return [], f"❌ Ranch '{ranch_name}' not found"
 
-    headers = _auth_headers(token)
     params = {}
     if active is not None:
         params["active"] = "true" if active else "false"
@@ -141,20 +260,22 @@ def get_plantings_for_ranch(token, ranch_name, active=True, commodity_type_id=No
     if ranch_guid:
         url = conf.PLANTINGS_BY_RANCH_GUID.format(ranch_guid=ranch_guid)
         try:
-            r = requests.get(url, headers=headers, params=params, timeout=25)
+            r = _SESSION.get(url, params=params, timeout=25)
             r.raise_for_status()
-            return r.json(), None
-        except requests.RequestException:
-            pass  # fall back
+            return _json(r), None
+        except requests.RequestException as e:
+            if not ranch_id:
+                return [], f"❌ Failed to fetch plantings: {e}"
+            # fall back
 
     # Numeric fallback
     url = conf.PLANTINGS_BY_RANCH_ID
     params_num = dict(params)
     params_num["ranchId"] = ranch_id
     try:
-        r = requests.get(url, headers=headers, params=params_num, timeout=25)
+        r = _SESSION.get(url, params=params_num, timeout=25)
         r.raise_for_status()
-        return r.json(), None
+        return _json(r), None
     except requests.RequestException as e:
         return [], f"❌ Failed to fetch plantings: {e}"
 
@@ -165,9 +286,19 @@ def count_plantings(token, ranch_name):
     return f"🌱 You have {len(plantings)} active plantings in {ranch_name}."
 
 # ---------- IRRIGATION & FERTILIZER (example) ----------
+def _first(data, *keys, default=None):
+    """Value of the first key present and not None; unlike an `or` chain,
+    a legitimate 0 recommendation is kept."""
+    return next((data[k] for k in keys if data.get(k) is not None), default)
+
+def _resolve_crop_and_ranch(crop, location, token):
+    """Look up (crop_type_id, ranch_id) concurrently; the two are independent."""
+    crop_f = _POOL.submit(get_crop_type_id, crop, token)
+    ranch_f = _POOL.submit(get_ranch_id, location, token)
+    return crop_f.result(), ranch_f.result()
+
 def get_irrigation_recommendation(crop, location, token):
-    crop_type_id = get_crop_type_id(crop, token)
-    ranch_id = get_ranch_id(location, token)
+    crop_type_id, ranch_id = _resolve_crop_and_ranch(crop, location, token)
     if not crop_type_id or not ranch_id:
         return "❌ Invalid crop or location"
 
@@ -178,19 +309,17 @@ def get_irrigation_recommendation(crop, location, token):
         "DistributionUniformity": 85.0
     }
     try:
-        resp = requests.post(conf.IRRIGATION, json=payload,
-                             headers={**_auth_headers(token), "Content-Type": "application/json"},
-                             timeout=25)
+        # json= sets Content-Type; the session already carries Authorization
+        resp = _SESSION.post(conf.IRRIGATION, json=payload, timeout=25)
         resp.raise_for_status()
-        data = resp.json()
-        recommended = data.get("RecommendedWater") or data.get("recommended") or 0
+        data = _json(resp)
+        recommended = _first(data, "RecommendedWater", "recommended", default=0)
         return f"Recommended irrigation: {float(recommended):.2f} inches"
     except requests.RequestException as e:
         return f"❌ Irrigation recommendation failed: {str(e)}"
 
 def get_fertilizer_recommendation(crop, location, token):
-    crop_type_id = get_crop_type_id(crop, token)
-    ranch_id = get_ranch_id(location, token)
+    crop_type_id, ranch_id = _resolve_crop_and_ranch(crop, location, token)
     if not crop_type_id or not ranch_id:
         return "❌ Invalid crop or location"
 
@@ -200,14 +329,12 @@ def get_fertilizer_recommendation(crop, location, token):
         "RecommendationType": "nitrogen"
     }
     try:
-        resp = requests.post(conf.FERTILIZER, json=payload,
-                             headers={**_auth_headers(token), "Content-Type": "application/json"},
-                             timeout=25)
+        resp = _SESSION.post(conf.FERTILIZER, json=payload, timeout=25)
         resp.raise_for_status()
-        data = resp.json()
-        amt  = data.get("amount") or data.get("Amount") or 0
-        unit = data.get("unit") or data.get("Unit") or "units"
-        nutr = data.get("nutrient") or data.get("Nutrient") or "N"
+        data = _json(resp)
+        amt  = _first(data, "amount", "Amount", default=0)
+        unit = _first(data, "unit", "Unit", default="units")
+        nutr = _first(data, "nutrient", "Nutrient", default="N")
         return f"Apply {amt} {unit} of {nutr}"
     except requests.RequestException as e:
         return f"❌ Fertilizer recommendation failed: {str(e)}"
@@ -7,4 +7,6 @@ class Config:
     RANCHES = f"{API_BASE}/v2/ranches.json"
     IRRIGATION = f"{API_BASE}/v2/irrigation-recommendation.json"
     FERTILIZER = f"{API_BASE}/v2/fertilizer-recommendation.json"
-    WEATHER_STATIONS = f"{API_BASE}/v2/weather/stations.json"
\ No newline at end of file
+    WEATHER_STATIONS = f"{API_BASE}/v2/weather/stations.json"
+    PLANTINGS_BY_RANCH_GUID = f"{API_BASE}/v2/ranches/{{ranch_guid}}/plantings.json"
+    PLANTINGS_BY_RANCH_ID = f"{API_BASE}/v2/plantings/list-by-ranch.json"
\ No newline at end of file
@@ -1,36 +1,77 @@
+import functools
+import re
+import string
 from difflib import get_close_matches
+from utils import normalize
+
+try:
+    from rapidfuzz import fuzz, process  # optional C++ matcher, much faster than difflib
+except ImportError:
+    process = None
+
+# Checked in this order: the first intent with any keyword in the input wins
+_INTENT_KEYWORDS = (
+    ("get_irrigation", ("irrigation", "water", "irrigate")),
+    ("get_fertilizer", ("fertilizer", "nutrient", "nitrogen", "npk")),
+    ("get_weather", ("weather", "temperature", "forecast")),
+    ("get_soil_status", ("soil", "moisture", "dirt")),
+)
+_KEYWORD_RANK = {kw: rank for rank, (_, kws) in enumerate(_INTENT_KEYWORDS) for kw in kws}
+# One scan for every keyword; the zero-width lookahead also reports
+# keywords that overlap, as the old substring tests did.
+_KEYWORD_RE = re.compile("(?=(%s))" % "|".join(
+    re.escape(kw) for kw in sorted(_KEYWORD_RANK, key=len, reverse=True)))
+
+@functools.lru_cache(maxsize=1024)
+def _closest(word, choices):
+    """Best fuzzy match for word among choices (similarity >= 0.7), or None.
+    Cached per word: users repeat the same crop and ranch names every turn."""
+    # Exact hits are the common case and would score 100 anyway
+    if word in choices:
+        return word
+    if process is not None:
+        hit = process.extractOne(word, choices, scorer=fuzz.ratio, score_cutoff=70)
+        return hit[0] if hit else None
+    match = get_close_matches(word, choices, n=1, cutoff=0.7)
+    return match[0] if match else None
 
 def recognize_intent(user_input, crops, locations):
-    user_input = user_input.lower()
+    # Normalize before the cache lookup so "Water  Lettuce?" and
+    # "water lettuce" share one entry, and "salinas?" hits "salinas" exactly.
+    # Only punctuation at the edges of a word goes: "bok-choy" stays whole.
+    words = (w.strip(string.punctuation) for w in normalize(user_input).split())
+    text = " ".join(w for w in words if w)
+    intent, parameters = _recognize(text, tuple(crops), tuple(locations))
+    # Fresh dict per call: callers fill in missing parameters themselves
+    return (intent, dict(parameters))
+
+@functools.lru_cache(maxsize=128)
+def _recognize(user_input, crops, locations):
     parameters = {}
     
-    # Extract crop
+    # Extract crop and location in one pass; each keeps its first match
     for word in user_input.split():
-        match = get_close_matches(word, crops, n=1, cutoff=0.7)
-        if match:
-            parameters["crop"] = match[0]
-            break
-    
-    # Extract location
-    for word in user_input.split():
-        match = get_close_matches(word, locations, n=1, cutoff=0.7)
-        if match:
-            parameters["location"] = match[0]
+        if "crop" not in parameters:
+            match = _closest(word, crops)
+            if match:
+                parameters["crop"] = match
+        if "location" not in parameters:
+            match = _closest(word, locations)
+            if match:
+                parameters["location"] = match
+        if len(parameters) == 2:
             break
 
     # Intent detection
-    irrigation_words = {"irrigation", "water", "irrigate"}
-    fertilizer_words = {"fertilizer", "nutrient", "nitrogen", "npk"}
-    weather_words = {"weather", "temperature", "forecast"}
-    soil_words = {"soil", "moisture", "dirt"}
-
-    if any(word in user_input for word in irrigation_words):
-        return ("get_irrigation", parameters)
-    elif any(word in user_input for word in fertilizer_words):
-        return ("get_fertilizer", parameters)
-    elif any(word in user_input for word in weather_words):
-        return ("get_weather", parameters)
-    elif any(word in user_input for word in soil_words):
-        return ("get_soil_status", parameters)
+    ranks = [_KEYWORD_RANK[m.group(1)] for m in _KEYWORD_RE.finditer(user_input)]
+    if ranks:
+        return (_INTENT_KEYWORDS[min(ranks)][0], parameters)
     
-    return ("unknown", parameters)
\ No newline at end of file
+    return ("unknown", parameters)
+
+def _cache_clear():
+    _recognize.cache_clear()
+    _closest.cache_clear()
+
+# Lets callers drop cached results, e.g. after refreshing crops/locations
+recognize_intent.cache_clear = _cache_clear
@@ -1,18 +1,41 @@
 import os
-from dotenv import load_dotenv
-from api_handler import authenticate, handle_intent, get_crops, get_locations
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from api_handler import authenticate, warmup, handle_intent, get_crops, get_locations
 from intents import recognize_intent
-from tts_engine import speak
+from utils import normalize
 
-load_dotenv()
+_speak = None
+
+def speak(text):
+    """Import tts_engine on first use (it degrades to text-only by itself)."""
+    global _speak
+    if _speak is None:
+        from tts_engine import speak as _speak
+    _speak(text)
+
+def lookup_tables(token):
+    # api_handler already normalized the names; tuples make them hashable
+    # cache keys for recognize_intent
+    return tuple(get_crops(token)), tuple(get_locations(token))
+
+BANNER = (
+    "🌱 CropManage Voice Agent v2.0\n"
+    "Available commands:\n"
+    "- Irrigation: 'How much water for strawberries in Salinas?'\n"
+    "- Fertilizer: 'Nitrogen recommendation for lettuce'\n"
+    "- Weather: 'What's the weather in Watsonville?'\n"
+    "Type 'exit' to quit\n\n"
+)
 
 def main():
-    print("🌱 CropManage Voice Agent v2.0")
-    print("Available commands:")
-    print("- Irrigation: 'How much water for strawberries in Salinas?'")
-    print("- Fertilizer: 'Nitrogen recommendation for lettuce'")
-    print("- Weather: 'What's the weather in Watsonville?'")
-    print("Type 'exit' to quit\n")
+    sys.stdout.write(BANNER)
+    sys.stdout.flush()
+
+    # .env is only needed when the shell doesn't already provide credentials
+    if not (os.getenv("CROP_USERNAME") and os.getenv("CROP_PASSWORD")):
+        from dotenv import load_dotenv
+        load_dotenv()
 
     # Authentication
     token = authenticate(os.getenv("CROP_USERNAME"), os.getenv("CROP_PASSWORD"))
@@ -21,38 +44,56 @@ def main():
         return
 
     auth = {"token": token}
-    crops = get_crops(token)
-    locations = get_locations(token)
+    warmup(token)
+    crops, locations = lookup_tables(token)
+    prefetch = ThreadPoolExecutor(max_workers=1)
+    refresh = None
 
-    while True:
-        try:
-            user_input = input("You: ").strip()
-            if user_input.lower() in {"exit", "quit", "bye"}:
-                speak("Goodbye!")
-                break
+    try:
+        while True:
+            try:
+                user_input = input("You: ").strip()
+                if user_input.lower() in {"exit", "quit", "bye"}:
+                    speak("Goodbye!")
+                    break
 
-            intent, params = recognize_intent(user_input, crops, locations)
+                # Pick up tables the background refresh rebuilt; a failed
+                # refresh keeps the lists we already have
+                if refresh is not None and refresh.done():
+                    if refresh.result():
+                        tables = lookup_tables(token)
+                        if all(tables) and tables != (crops, locations):
+                            crops, locations = tables
+                            recognize_intent.cache_clear()
+                    refresh = None
+
+                intent, params = recognize_intent(user_input, crops, locations)
             
-            # Show understood parameters
-            if params:
-                print(f"🔎 Detected: {', '.join(f'{k}:{v}' for k,v in params.items())}")
+                # Show understood parameters
+                if params:
+                    print(f"🔎 Detected: {', '.join(f'{k}:{v}' for k,v in params.items())}")
             
-            # Handle missing parameters
-            if intent in {"get_irrigation", "get_fertilizer"}:
-                if "crop" not in params:
-                    print(f"Available crops: {', '.join(crops)}")
-                    params["crop"] = input("Which crop? ").lower()
-                if "location" not in params:
-                    print(f"Available locations: {', '.join(locations)}")
-                    params["location"] = input("Which location? ").lower()
-
-            response = handle_intent(intent, params, auth)
-            print("Agent:", response)
-            speak(response)
-
-        except Exception as e:
-            print(f"❌ Error: {str(e)}")
-            speak("Sorry, I encountered an error")
+                # Handle missing parameters
+                if intent in {"get_irrigation", "get_fertilizer"}:
+                    if "crop" not in params:
+                        print(f"Available crops: {', '.join(crops)}")
+                        params["crop"] = normalize(input("Which crop? "))
+                    if "location" not in params:
+                        print(f"Available locations: {', '.join(locations)}")
+                        params["location"] = normalize(input("Which location? "))
+
+                response = handle_intent(intent, params, auth)
+                print("Agent:", response)
+                speak(response)
+                # Refresh any expired ranch/crop tables while the user reads
+                if refresh is None:
+                    refresh = prefetch.submit(warmup, token)
+
+            except Exception as e:
+                print(f"❌ Error: {str(e)}")
+                speak("Sorry, I encountered an error")
+    finally:
+        prefetch.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,6 +1,55 @@
-import pyttsx3
+import atexit
+import queue
+import threading
+
+# Utterances are spoken on a worker thread so the REPL can take the next
+# question while the previous answer is still playing.
+_queue = queue.Queue(maxsize=8)
+_worker = None
+_worker_lock = threading.Lock()
+
+def _run():
+    # pyttsx3 and its platform speech driver load here, once, on the thread
+    # that will drive them
+    try:
+        import pyttsx3
+        engine = pyttsx3.init()
+    except (ImportError, RuntimeError, OSError):
+        return  # no usable speech backend: the agent stays text-only
+    while True:
+        text = _queue.get()
+        if text is None:
+            break
+        try:
+            engine.say(text)
+            engine.runAndWait()
+        except (RuntimeError, OSError):
+            pass  # skip this utterance, keep serving the next ones
+    engine.stop()
+
+def _flush():
+    """Let queued speech (e.g. the final "Goodbye!") finish before exit."""
+    if not _worker.is_alive():
+        return
+    try:
+        _queue.put(None, timeout=5)
+    except queue.Full:
+        return
+    _worker.join(timeout=30)
+
+def _ensure_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_run, name="tts", daemon=True)
+            _worker.start()
+            atexit.register(_flush)
 
 def speak(text):
-    engine = pyttsx3.init()
-    engine.say(text)
-    engine.runAndWait()
\ No newline at end of file
+    _ensure_worker()
+    if not _worker.is_alive():
+        return
+    try:
+        _queue.put_nowait(text)
+    except queue.Full:
+        pass  # the reply is already on screen; don't block the REPL
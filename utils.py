@@ -0,0 +1,4 @@
+def normalize(text):
+    """Canonical form of user text and of crop/ranch names, so both sides
+    of a comparison are folded the same way."""
+    return (text or "").strip().casefold()